@@ -20,12 +20,16 @@ import win32api
 import win32gui
 import win32gui_struct
 import win32clipboard
+import win32job
 import pywintypes
 import base64
+import signal
+import codecs
+import hashlib
 from win32com.shell import shell, shellcon
 from io import StringIO
-from subprocess import Popen, PIPE, STDOUT
-from threading import Thread
+from subprocess import Popen, PIPE, STDOUT, TimeoutExpired
+from threading import Thread, Lock, Event, get_ident, enumerate as enum_threads
 
 def msgbox(text, caption='Error'):
     win32gui.MessageBox(None, text, caption,
@@ -39,6 +43,45 @@ def shellopen(cmd, path, cwd=None):
     return win32api.ShellExecute(None, cmd, path, None, cwd,
                                  win32con.SW_SHOWDEFAULT)
 
+def getcodec(name):
+    if name.isdigit():
+        # Windows codepage number, e.g. 932.
+        name = 'cp'+name
+    name = codecs.lookup(name).name
+    # Refuse bytes-to-bytes codecs such as base64 or zlib;
+    # str.encode() raises LookupError for them.
+    try:
+        'x'.encode(name).decode(name)
+    except UnicodeError:
+        raise LookupError(name)
+    return name
+
+def chan_sendall(chan, data, stderr=False):
+    # Channel.sendall() gives up on a timeout; keep trying.
+    send = chan.send_stderr if stderr else chan.send
+    while data:
+        try:
+            n = send(data)
+        except socket.timeout:
+            continue
+        data = data[n:]
+    return
+
+def confine(basedir, path):
+    # Resolves path under basedir, refusing anything outside of it.
+    # The base directory itself is not allowed either.
+    basedir = os.path.realpath(basedir)
+    path = os.path.realpath(os.path.join(basedir, path))
+    try:
+        if (os.path.normcase(os.path.commonpath([basedir, path])) ==
+            os.path.normcase(basedir) and
+            os.path.normcase(path) != os.path.normcase(basedir)):
+            return path
+    except ValueError:
+        # Different drives.
+        pass
+    raise ValueError(path)
+
 windows = (sys.stdout is None)
 if windows:
     error = msgbox
@@ -267,10 +310,13 @@ class PyRexecTrayApp(SysTrayApp):
 ##
 class PyRexecServer(paramiko.ServerInterface):
 
-    def __init__(self, username, pubkeys, codec='utf-8'):
+    ENV_CODEPAGE = 'PYREXECD_CODEPAGE'
+
+    def __init__(self, username, pubkeys, codec='utf-8', cmdcodec=None):
         self.username = username
         self.pubkeys = pubkeys
         self.codec = codec
+        self.cmdcodec = cmdcodec
         self.command = None
         self.ready = False
         return
@@ -298,6 +344,20 @@ class PyRexecServer(paramiko.ServerInterface):
         self.ready = True
         return True
 
+    def check_channel_env_request(self, channel, name, value):
+        logging.debug(f'check_channel_env_request: {name!r}={value!r}')
+        if isinstance(name, bytes):
+            name = name.decode('ascii', 'replace')
+        if isinstance(value, bytes):
+            value = value.decode('ascii', 'replace')
+        if name == self.ENV_CODEPAGE:
+            try:
+                self.cmdcodec = getcodec(value) if value else None
+            except LookupError:
+                return False
+            return True
+        return False
+
     def check_channel_exec_request(self, channel, command):
         logging.debug(f'check_channel_exec_request: {command!r}')
         try:
@@ -308,11 +368,250 @@ class PyRexecServer(paramiko.ServerInterface):
         return True
 
 
+##  ProcessTree
+##
+##  Runs a command so that all of its descendants can be killed together:
+##  in a Job object on Windows, in a new process group elsewhere.
+##
+class ProcessTree:
+
+    def __init__(self, args, cwd=None):
+        if os.name == 'nt':
+            self._job = win32job.CreateJobObject(None, '')
+            info = win32job.QueryInformationJobObject(
+                self._job, win32job.JobObjectExtendedLimitInformation)
+            info['BasicLimitInformation']['LimitFlags'] |= (
+                win32job.JOB_OBJECT_LIMIT_KILL_ON_JOB_CLOSE)
+            win32job.SetInformationJobObject(
+                self._job, win32job.JobObjectExtendedLimitInformation, info)
+            self._proc = Popen(
+                args, stdin=PIPE, stdout=PIPE, stderr=STDOUT,
+                cwd=cwd, creationflags=win32con.CREATE_NO_WINDOW)
+            # XXX Popen cannot start the process suspended, so anything
+            # it spawns before the assignment below escapes the job.
+            # cmd.exe reads its command line first, so this is unlikely.
+            try:
+                handle = win32api.OpenProcess(
+                    (win32con.PROCESS_TERMINATE | win32con.PROCESS_SET_QUOTA),
+                    False, self._proc.pid)
+                try:
+                    win32job.AssignProcessToJobObject(self._job, handle)
+                finally:
+                    win32api.CloseHandle(handle)
+            except pywintypes.error:
+                self._proc.kill()
+                self._proc.wait()
+                win32api.CloseHandle(self._job)
+                raise
+        else:
+            self._proc = Popen(
+                args, stdin=PIPE, stdout=PIPE, stderr=STDOUT,
+                cwd=cwd, start_new_session=True)
+            self._job = None
+        self.pid = self._proc.pid
+        self.stdin = self._proc.stdin
+        self.stdout = self._proc.stdout
+        return
+
+    def __repr__(self):
+        return (f'<{self.__class__.__name__}: pid={self.pid}>')
+
+    def wait(self, timeout=None):
+        try:
+            status = self._proc.wait(timeout)
+        except TimeoutExpired:
+            return None
+        if status < 0:
+            # Killed by a signal: report it the way a shell does.
+            status = 128-status
+        return status
+
+    def _signal(self, sig):
+        try:
+            os.killpg(self.pid, sig)
+        except OSError:
+            pass
+        return
+
+    def terminate(self):
+        if self._job is None:
+            self._signal(signal.SIGTERM)
+        else:
+            self.kill()
+        return
+
+    def kill(self):
+        if self._job is None:
+            self._signal(signal.SIGKILL)
+        else:
+            try:
+                win32job.TerminateJobObject(self._job, 1)
+            except pywintypes.error:
+                pass
+        return
+
+    def close(self):
+        # Kill whatever is left of the tree and release it.
+        self.kill()
+        if self._job is not None:
+            win32api.CloseHandle(self._job)
+            self._job = None
+        return
+
+
+##  Transcoder
+##
+##  Converts a byte stream from one encoding to another chunk by chunk.
+##  Characters split across chunks are kept until the rest arrives.
+##
+class Transcoder:
+
+    def __init__(self, src, dst, errors='replace'):
+        self.src = src
+        self.dst = dst
+        self._decoder = codecs.getincrementaldecoder(src)(errors)
+        self._encoder = codecs.getincrementalencoder(dst)(errors)
+        return
+
+    def __repr__(self):
+        return (f'<{self.__class__.__name__}: {self.src} -> {self.dst}>')
+
+    def feed(self, data, final=False):
+        text = self._decoder.decode(data, final)
+        return self._encoder.encode(text, final)
+
+    def flush(self):
+        return self.feed(b'', final=True)
+
+
+##  ChunkDigest
+##
+##  Computes the SHA-256 of each fixed-size chunk and of the whole stream.
+##  Chunks are aligned to absolute offsets so that a transfer resumed
+##  in the middle reports the same chunks.
+##
+class ChunkDigest:
+
+    def __init__(self, chunksize=1024*1024):
+        self.chunksize = chunksize
+        self.offset = 0
+        self._start = 0
+        self._file = hashlib.sha256()
+        self._chunk = hashlib.sha256()
+        return
+
+    def __repr__(self):
+        return (f'<{self.__class__.__name__}: offset={self.offset}>')
+
+    def _finish(self):
+        chunk = (self._start, self.offset-self._start, self._chunk.hexdigest())
+        self._start = self.offset
+        self._chunk = hashlib.sha256()
+        return chunk
+
+    def update(self, data):
+        # Returns a list of finished chunks: (offset, size, sha256).
+        chunks = []
+        data = memoryview(data)
+        while data:
+            n = min(len(data), self._start+self.chunksize-self.offset)
+            self._chunk.update(data[:n])
+            self._file.update(data[:n])
+            self.offset += n
+            data = data[n:]
+            if self.offset == self._start+self.chunksize:
+                chunks.append(self._finish())
+        return chunks
+
+    def finish(self):
+        # Returns the last chunks and the whole size and sha256.
+        chunks = []
+        if self._start < self.offset:
+            chunks.append(self._finish())
+        return (chunks, (self.offset, self._file.hexdigest()))
+
+
+##  Sampler
+##
+##  Sampling profiler for all the threads in the server.
+##  Stacks are counted in the collapsed format ("a;b;c count").
+##  Nothing runs unless it is started.
+##
+class Sampler:
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._thread = None
+        self._stopped = None
+        self._lock = Lock()
+        self._stacks = {}
+        self._nsamples = 0
+        return
+
+    def __repr__(self):
+        return (f'<{self.__class__.__name__}: interval={self.interval}>')
+
+    def is_running(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None: return False
+            self._stacks = {}
+            self._nsamples = 0
+            # Each run has its own event so that a new run
+            # cannot keep an old one going.
+            self._stopped = Event()
+            self._thread = Thread(target=self._run, args=(self._stopped,),
+                                  daemon=True)
+            self._thread.start()
+        return True
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None: return False
+            (thread, self._thread) = (self._thread, None)
+            self._stopped.set()
+        thread.join()
+        return True
+
+    def _run(self, stopped):
+        me = get_ident()
+        while not stopped.is_set():
+            names = { t.ident: t.name for t in enum_threads() }
+            frames = sys._current_frames()
+            with self._lock:
+                for (tid, frame) in frames.items():
+                    if tid == me: continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        filename = os.path.basename(code.co_filename)
+                        stack.append(
+                            f'{code.co_name} ({filename}:{code.co_firstlineno})')
+                        frame = frame.f_back
+                    stack.append(names.get(tid, str(tid)))
+                    key = ';'.join(reversed(stack))
+                    self._stacks[key] = self._stacks.get(key, 0) + 1
+                self._nsamples += 1
+            del frames
+            stopped.wait(self.interval)
+        return
+
+    def dump(self):
+        with self._lock:
+            lines = [ f'{k} {v}\n' for (k,v) in sorted(self._stacks.items()) ]
+            lines.insert(
+                0, f'# samples={self._nsamples}, interval={self.interval}\n')
+        return ''.join(lines)
+
+
 ##  PyRexecSession
 ##
 class PyRexecSession:
 
-    def __init__(self, app, name, chan, homedir, cmdexe, server, timeout=10):
+    def __init__(self, app, name, chan, homedir, cmdexe, server, timeout=10,
+                 profiler=None):
         self.logger = logging.getLogger(name)
         self.app = app
         self.name = name
@@ -320,9 +619,16 @@ class PyRexecSession:
         self.homedir = homedir
         self.cmdexe = cmdexe
         self.server = server
-        self.bufsize = 512
+        self.profiler = profiler
+        self.bufsize = 32768
+        self.chunksize = 1024*1024
+        self.killtimeout = 3
+        self.status = 0
         self._timeout = time.time()+timeout
         self._tasks = None
+        self._proc = None
+        self._chanfwd = None
+        self._pipefwd = None
         self._events = []
         return
 
@@ -365,26 +671,54 @@ class PyRexecSession:
         self.chan.settimeout(0.05)
         self._add_event('open')
         self._tasks = []
-        self._proc = None
         try:
             self.exec_command(self.server.command)
         except (OSError, pywintypes.error) as e:
             self.logger.error(f'error: {e!r}')
         return
 
-    def close(self, status=0):
+    def close(self, status=None):
+        if status is None:
+            status = self.status
         self.logger.info(f'close: {self.chan!r}, status={status!r}')
         self._tasks = []
-        if self._proc is None:
-            status = 0
-        else:
-            self._proc.terminate()
-            status = self._proc.wait()
-        self.chan.send_exit_status(status)
+        # Waiting for the process may take a while; do it elsewhere.
+        Thread(target=self._teardown, args=(status,)).start()
+        return
+
+    def _teardown(self, status):
+        if self._proc is not None:
+            status = self._stop_proc(self._proc)
+            # Let the remaining output reach the client first.
+            if self._pipefwd is not None:
+                self._pipefwd.join(self.killtimeout)
+        self.logger.debug(f'exit status: {status!r}')
+        try:
+            self.chan.send_exit_status(status)
+        except (IOError, socket.error) as e:
+            self.logger.error(f'chan error: {e!r}')
         self.chan.close()
         self._add_event('closed')
         return
 
+    def _stop_proc(self, proc):
+        # Give the process a chance to exit by itself at EOF,
+        # then terminate the whole tree, and finally kill it.
+        # (ChanForwarder closes stdin when it stops.)
+        if self._chanfwd is not None:
+            self._chanfwd.stop()
+        status = proc.wait(self.killtimeout)
+        if status is None:
+            self.logger.info(f'terminate: {proc!r}')
+            proc.terminate()
+            status = proc.wait(self.killtimeout)
+        if status is None:
+            self.logger.info(f'kill: {proc!r}')
+            proc.kill()
+            status = proc.wait()
+        proc.close()
+        return status
+
     def exec_command(self, command):
         self.logger.info(f'exec_command: {command!r}')
         if command == '@clipget':
@@ -393,6 +727,17 @@ class PyRexecSession:
         if command == '@clipset':
             self._add_task(self.ClipSetter(self, self.chan))
             return
+        if command is not None and command.split(' ')[0] == '@profile':
+            self._add_task(self.ProfileCommand(
+                self, self.chan, command.split()[1:]))
+            return
+        if command is not None and command.split(' ')[0] in ('@put', '@get'):
+            (cmd, _, args) = command.partition(' ')
+            if cmd == '@put':
+                self._add_task(self.FileReceiver(self, self.chan, args))
+            else:
+                self._add_task(self.FileSender(self, self.chan, args))
+            return
         if command is not None and command.startswith('@'):
             self._add_task(self.FileOpener(self, self.chan, command[1:]))
             return
@@ -400,11 +745,21 @@ class PyRexecSession:
             args = self.cmdexe
         else:
             args = self.cmdexe+['/C', command]
-        self._proc = Popen(
-            args, stdin=PIPE, stdout=PIPE, stderr=STDOUT,
-            cwd=self.homedir, creationflags=win32con.CREATE_NO_WINDOW)
-        self._add_task(self.ChanForwarder(self, self.chan, self._proc.stdin))
-        self._add_task(self.PipeForwarder(self, self._proc.stdout, self.chan))
+        self._proc = ProcessTree(args, cwd=self.homedir)
+        codec = self.server.codec
+        cmdcodec = self.server.cmdcodec
+        if cmdcodec is None or codecs.lookup(codec).name == cmdcodec:
+            (encoder, decoder) = (None, None)
+        else:
+            self.logger.info(f'transcode: {codec!r} <-> {cmdcodec!r}')
+            encoder = Transcoder(codec, cmdcodec)
+            decoder = Transcoder(cmdcodec, codec)
+        self._chanfwd = self.ChanForwarder(
+            self, self.chan, self._proc.stdin, encoder)
+        self._pipefwd = self.PipeForwarder(
+            self, self._proc.stdout, self.chan, decoder)
+        self._add_task(self._chanfwd)
+        self._add_task(self._pipefwd)
         return
 
     def _clipget(self):
@@ -418,44 +773,102 @@ class PyRexecSession:
         win32clipboard.CloseClipboard()
         return
 
+    class ProfileCommand(Thread):
+        def __init__(self, session, chan, args):
+            Thread.__init__(self)
+            self.session = session
+            self.chan = chan
+            self.args = args
+            return
+        def reply(self, s, stderr=False):
+            chan_sendall(self.chan, s.encode(self.session.server.codec),
+                         stderr=stderr)
+            return
+        def error(self, s):
+            self.session.status = 1
+            self.session.logger.error(s)
+            self.reply(s+'\n', stderr=True)
+            return
+        def run(self):
+            profiler = self.session.profiler
+            try:
+                if profiler is None:
+                    self.error('profiling is disabled')
+                    return
+                cmd = self.args[0] if self.args else 'dump'
+                if cmd == 'start':
+                    if profiler.start():
+                        self.session.logger.info(f'profile start: {profiler!r}')
+                        self.reply('started\n')
+                    else:
+                        self.reply('already running\n')
+                elif cmd == 'stop':
+                    if profiler.stop():
+                        self.session.logger.info(f'profile stop: {profiler!r}')
+                    self.reply(profiler.dump())
+                elif cmd == 'dump':
+                    self.reply(profiler.dump())
+                else:
+                    self.error('usage: @profile start|stop|dump')
+            except (IOError, socket.error) as e:
+                self.session.logger.error(f'chan error: {e!r}')
+            return
+
     class ChanForwarder(Thread):
-        def __init__(self, session, chan, pipe):
+        def __init__(self, session, chan, pipe, transcoder=None):
             Thread.__init__(self)
             self.session = session
             self.chan = chan
             self.pipe = pipe
+            self.transcoder = transcoder
+            self._stopped = False
+            return
+        def stop(self):
+            self._stopped = True
             return
         def run(self):
-            while 1:
+            while not self._stopped:
                 try:
                     data = self.chan.recv(self.session.bufsize)
                     if not data: break
+                    if self.transcoder is not None:
+                        data = self.transcoder.feed(data)
                     self.pipe.write(data)
                     self.pipe.flush()
                 except socket.timeout:
                     continue
-                except (IOError, socket.error) as e:
+                except (IOError, ValueError, socket.error) as e:
                     self.session.logger.error(f'chan error: {e!r}')
                     break
             self.session.logger.debug('chan end')
-            self.pipe.close()
+            try:
+                if self.transcoder is not None:
+                    self.pipe.write(self.transcoder.flush())
+                self.pipe.close()
+            except (IOError, ValueError):
+                pass
             return
 
     class PipeForwarder(Thread):
-        def __init__(self, session, pipe, chan):
+        def __init__(self, session, pipe, chan, transcoder=None):
             Thread.__init__(self)
             self.session = session
             self.pipe = pipe
             self.chan = chan
+            self.transcoder = transcoder
             return
         def run(self):
             while 1:
                 try:
-                    data = self.pipe.read(1)
-                    if not data: break
-                    self.chan.send(data)
-                except socket.timeout:
-                    continue
+                    # Send whatever is available, without waiting for more.
+                    data = self.pipe.read1(self.session.bufsize)
+                    if not data:
+                        if self.transcoder is not None:
+                            chan_sendall(self.chan, self.transcoder.flush())
+                        break
+                    if self.transcoder is not None:
+                        data = self.transcoder.feed(data)
+                    chan_sendall(self.chan, data)
                 except (IOError, socket.error) as e:
                     self.session.logger.error(f'pipe error: {e!r}')
                     break
@@ -463,6 +876,195 @@ class PyRexecSession:
             self.pipe.close()
             return
 
+    class FileTransfer(Thread):
+        # "[-o offset] path"
+        OPTIONS = ('-o',)
+        def __init__(self, session, chan, args):
+            Thread.__init__(self)
+            self.session = session
+            self.chan = chan
+            self.args = args
+            self.digest = ChunkDigest(session.chunksize)
+            return
+        def parse_args(self, args):
+            opts = {}
+            args = args.strip()
+            while args.startswith('-'):
+                (k, _, args) = args.partition(' ')
+                if k == '--': break
+                (v, _, args) = args.lstrip().partition(' ')
+                if k not in self.OPTIONS or not v:
+                    raise ValueError(f'invalid option: {k!r}')
+                opts[k] = v
+                args = args.lstrip()
+            path = args.strip()
+            if 2 <= len(path) and path[0] == path[-1] == '"':
+                path = path[1:-1]
+            if not path:
+                raise ValueError('no path given')
+            return (path, opts)
+        def report(self, chunks, stderr=False):
+            lines = [ f'chunk {offset} {size} {h}\n'
+                      for (offset, size, h) in chunks ]
+            if lines:
+                data = ''.join(lines).encode(self.session.server.codec)
+                chan_sendall(self.chan, data, stderr=stderr)
+            return
+        def report_file(self, size, h, stderr=False):
+            data = f'file {size} {h}\n'.encode(self.session.server.codec)
+            chan_sendall(self.chan, data, stderr=stderr)
+            return
+        def error(self, s):
+            self.session.status = 1
+            self.session.logger.error(s)
+            try:
+                data = f'error: {s}\n'.encode(self.session.server.codec)
+                chan_sendall(self.chan, data, stderr=True)
+            except socket.error as e:
+                self.session.logger.error(f'chan error: {e!r}')
+            return
+        def hash_prefix(self, fp, size):
+            # Digests the data before the resumed offset.
+            fp.seek(0)
+            chunks = []
+            while self.digest.offset < size:
+                n = min(self.session.chunksize, size-self.digest.offset)
+                data = fp.read(n)
+                if not data: break
+                chunks.extend(self.digest.update(data))
+            return chunks
+        def run(self):
+            try:
+                (path, opts) = self.parse_args(self.args)
+                self.opts = opts
+            except ValueError as e:
+                self.error(f'{e}')
+                return
+            v = opts.get('-o', '0')
+            try:
+                self.offset = int(v)
+                if self.offset < 0: raise ValueError(v)
+            except ValueError:
+                self.error(f'invalid offset: {v!r}')
+                return
+            try:
+                path = confine(self.session.homedir, path)
+            except ValueError:
+                self.error(f'invalid path: {path!r}')
+                return
+            if os.path.isdir(path):
+                self.error(f'is a directory: {path!r}')
+                return
+            self.session.logger.info(
+                f'{self.__class__.__name__}: path={path!r}, offset={self.offset}')
+            try:
+                self.transfer(path)
+            except (IOError, socket.error) as e:
+                self.error(f'{e!r}')
+            return
+
+    class FileSender(FileTransfer):
+        # Data goes to stdout, digests go to stderr.
+        def transfer(self, path):
+            with open(path, 'rb') as fp:
+                size = os.fstat(fp.fileno()).st_size
+                if size < self.offset:
+                    self.error(f'offset beyond the end: {size}')
+                    return
+                self.report(self.hash_prefix(fp, self.offset), stderr=True)
+                fp.seek(self.offset)
+                while 1:
+                    data = fp.read(self.session.chunksize)
+                    if not data: break
+                    chunks = self.digest.update(data)
+                    chan_sendall(self.chan, data)
+                    self.report(chunks, stderr=True)
+            (chunks, (size, h)) = self.digest.finish()
+            self.report(chunks, stderr=True)
+            self.report_file(size, h, stderr=True)
+            return
+
+    class FileReceiver(FileTransfer):
+        # "[-o offset] [-s size] [-h sha256] path"
+        # Data comes from stdin, digests go to stdout.
+        # It is written to path.part, which is renamed to path
+        # only when the expected size and sha256 match.
+        OPTIONS = ('-o', '-s', '-h')
+        _lock = Lock()
+        _active = set()
+        def transfer(self, path):
+            size = self.opts.get('-s')
+            sha256 = self.opts.get('-h')
+            if size is None and sha256 is None:
+                self.error('expected size (-s) or sha256 (-h) is required')
+                return
+            try:
+                size = None if size is None else int(size)
+            except ValueError:
+                self.error(f'invalid size: {size!r}')
+                return
+            tmppath = path+'.part'
+            try:
+                if confine(self.session.homedir, tmppath) != tmppath:
+                    raise ValueError(tmppath)
+            except ValueError:
+                self.error(f'invalid path: {tmppath!r}')
+                return
+            with self._lock:
+                if tmppath in self._active:
+                    self.error(f'transfer in progress: {tmppath!r}')
+                    return
+                self._active.add(tmppath)
+            try:
+                self.receive(path, tmppath, size, sha256)
+            finally:
+                with self._lock:
+                    self._active.discard(tmppath)
+            return
+        def receive(self, path, tmppath, size, sha256):
+            if self.offset == 0:
+                fp = open(tmppath, 'w+b')
+            else:
+                try:
+                    fp = open(tmppath, 'r+b')
+                except FileNotFoundError:
+                    self.error('nothing to resume')
+                    return
+            with fp:
+                partsize = os.fstat(fp.fileno()).st_size
+                if partsize < self.offset:
+                    self.error(f'cannot resume beyond {partsize}')
+                    return
+                self.report(self.hash_prefix(fp, self.offset))
+                fp.seek(self.offset)
+                fp.truncate()
+                while 1:
+                    try:
+                        data = self.chan.recv(self.session.bufsize)
+                    except socket.timeout:
+                        continue
+                    if not data: break
+                    fp.write(data)
+                    chunks = self.digest.update(data)
+                    if chunks:
+                        # Make sure the reported chunks are really there.
+                        fp.flush()
+                        os.fsync(fp.fileno())
+                        self.report(chunks)
+                fp.flush()
+                os.fsync(fp.fileno())
+            (chunks, (received, h)) = self.digest.finish()
+            self.report(chunks)
+            self.report_file(received, h)
+            if size is not None and received != size:
+                self.error(f'incomplete: {received} of {size} bytes')
+                return
+            if sha256 is not None and h != sha256.lower():
+                self.error(f'sha256 mismatch: {h}')
+                return
+            os.replace(tmppath, path)
+            return
+
     class DataReceiver(Thread):
         def __init__(self, session, chan):
             Thread.__init__(self)
@@ -555,7 +1157,7 @@ def get_authorized_keys(path):
 
 # run_server
 def run_server(app, sock, hostkeys, username, pubkeys, homedir, cmdexe,
-               msg='Listening...'):
+               cmdcodec=None, profiler=None, msg='Listening...'):
     def update_text(n):
         if n:
             app.set_text(msg + f'\n(Clients: {n})')
@@ -593,12 +1195,13 @@ def run_server(app, sock, hostkeys, username, pubkeys, homedir, cmdexe,
         for k in hostkeys:
             t.add_server_key(k)
         name = 'Session-%s-%s' % peer
-        server = PyRexecServer(username, pubkeys)
+        server = PyRexecServer(username, pubkeys, cmdcodec=cmdcodec)
         try:
             t.start_server(server=server)
             chan = t.accept(10)
             if chan is not None:
-                session = PyRexecSession(app, name, chan, homedir, cmdexe, server)
+                session = PyRexecSession(app, name, chan, homedir, cmdexe, server,
+                                         profiler=profiler)
                 sessions.append(session)
             else:
                 logging.error('Timeout')
@@ -615,12 +1218,12 @@ def run_server(app, sock, hostkeys, username, pubkeys, homedir, cmdexe,
 def main(argv):
     import getopt
     def usage():
-        error(f'Usage: {argv[0]} [-d] [-l logfile] [-s sshdir] [-L addr]'
-              ' [-p port] [-c cmdexe] [-u username] [-a authkeys] [-h homedir]'
-              ' ssh_host_key ...')
+        error(f'Usage: {argv[0]} [-d] [-P] [-l logfile] [-s sshdir] [-L addr]'
+              ' [-p port] [-c cmdexe] [-C codepage] [-u username]'
+              ' [-a authkeys] [-h homedir] ssh_host_key ...')
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'dl:s:L:p:u:a:h:c:')
+        (opts, args) = getopt.getopt(argv[1:], 'dPl:s:L:p:u:a:h:c:C:')
     except getopt.GetoptError:
         return usage()
     homedir = getpath(shellcon.CSIDL_PROFILE)
@@ -636,8 +1239,11 @@ def main(argv):
     username = win32api.GetUserName()
     authkeys = []
     cmdexe = ['cmd','/Q']
+    cmdcodec = None
+    profiler = None
     for (k, v) in opts:
         if k == '-d': loglevel = logging.DEBUG
+        elif k == '-P': profiler = Sampler()
         elif k == '-l': logfile = v
         elif k == '-L': addr = v
         elif k == '-s': sshdir = v
@@ -646,6 +1252,11 @@ def main(argv):
         elif k == '-a': authkeys.append(v)
         elif k == '-h': homedir = v
         elif k == '-c': cmdexe = v.split(' ')
+        elif k == '-C':
+            try:
+                cmdcodec = getcodec(v)
+            except LookupError:
+                return usage()
     try:
         os.makedirs(sshdir)
     except OSError:
@@ -687,6 +1298,7 @@ def main(argv):
     logging.info(f'Username: {username!r} (pubkeys:{len(pubkeys)})')
     logging.info(f'Homedir: {homedir!r}')
     logging.info(f'Cmd.exe: {cmdexe!r}')
+    logging.info(f'Codepage: {cmdcodec!r}')
     logging.info(f'Listening: {addr}:{port}...')
     PyRexecTrayApp.initialize(os.path.dirname(__file__))
     try:
@@ -699,6 +1311,7 @@ def main(argv):
         sock.settimeout(0.05)
         app = PyRexecTrayApp()
         run_server(app, sock, hostkeys, username, pubkeys, homedir, cmdexe,
+                   cmdcodec=cmdcodec, profiler=profiler,
                    msg=(f'Listening: {addr}:{port}...'))
     except (OSError, socket.error) as e:
         logging.error(f'Error: {e!r}')
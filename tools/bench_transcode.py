@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+##  bench_transcode.py
+##
+##  Measures the per-MB cost of the codepage transcoding stage
+##  used by PipeForwarder / ChanForwarder.
+##
+##  usage:
+##    > python tools\bench_transcode.py [-n mbytes] [-b bufsize] [codepage ...]
+
+import sys
+import time
+from pyrexecd import Transcoder, getcodec
+
+SAMPLE = ('C:\\Users\\euske> dir\r\n'
+          ' 2024/01/01  12:00    <DIR>          \u30c9\u30ad\u30e5\u30e1\u30f3\u30c8\r\n'
+          ' 2024/01/01  12:00             1,234 caf\u00e9.txt\r\n')
+
+def feed(transcoder, data, bufsize):
+    n = 0
+    for i in range(0, len(data), bufsize):
+        n += len(transcoder.feed(data[i:i+bufsize]))
+    n += len(transcoder.flush())
+    return n
+
+def bench(src, dst, data, bufsize):
+    t0 = time.perf_counter()
+    feed(Transcoder(src, dst), data, bufsize)
+    return time.perf_counter() - t0
+
+def main(argv):
+    import getopt
+    def usage():
+        print(f'usage: {argv[0]} [-n mbytes] [-b bufsize] [codepage ...]')
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'n:b:')
+    except getopt.GetoptError:
+        return usage()
+    mbytes = 16
+    bufsize = 32768
+    for (k, v) in opts:
+        if k == '-n': mbytes = int(v)
+        elif k == '-b': bufsize = int(v)
+    codepages = args or ['932', '437', '1252']
+    print(f'bufsize={bufsize}, {mbytes}MB per run')
+    for cp in codepages:
+        codec = getcodec(cp)
+        text = SAMPLE.encode(codec, 'replace').decode(codec)
+        size = mbytes*1024*1024
+        text = text * (size // len(text.encode(codec)) + 1)
+        output = text.encode(codec)[:size]
+        t = bench(codec, 'utf-8', output, bufsize)
+        print(f'{codec:>8} -> utf-8: {t*1000/mbytes:7.2f} ms/MB')
+        indata = text.encode('utf-8')[:size]
+        t = bench('utf-8', codec, indata, bufsize)
+        print(f'utf-8 -> {codec:>8}: {t*1000/mbytes:7.2f} ms/MB')
+    return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
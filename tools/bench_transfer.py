@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+##  bench_transfer.py
+##
+##  Measures the throughput of @put/@get and checks that
+##  an interrupted @put can be resumed.
+##
+##  usage:
+##    $ python tools/bench_transfer.py [-p port] [-u username] [-i keyfile]
+##                                     [-n mbytes] [-r remotepath] host
+
+import sys
+import os
+import time
+import hashlib
+import tempfile
+import paramiko
+
+BUFSIZE = 1024*1024
+
+def connect(host, port, username, keyfile):
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(host, port=port, username=username, key_filename=keyfile,
+                   allow_agent=(keyfile is None))
+    return client
+
+def parse_reports(text):
+    # Returns the committed offset and the whole-file digest, if any.
+    committed = 0
+    filehash = None
+    for line in text.splitlines():
+        flds = line.split(' ')
+        if flds[0] == 'chunk':
+            committed = int(flds[1]) + int(flds[2])
+        elif flds[0] == 'file':
+            filehash = (int(flds[1]), flds[2])
+    return (committed, filehash)
+
+# Each command uses its own connection, as the server accepts
+# only one channel per connection.
+
+def put(connect, path, remote, digest, offset=0, limit=None):
+    # Sends path[offset:limit]. Without limit, it closes stdin at the end;
+    # with limit, it drops the connection as if the network went down.
+    (size, h) = digest
+    client = connect()
+    chan = client.get_transport().open_session()
+    chan.exec_command(f'@put -o {offset} -s {size} -h {h} {remote}')
+    out = b''
+    with open(path, 'rb') as fp:
+        fp.seek(offset)
+        while limit is None or fp.tell() < limit:
+            n = BUFSIZE if limit is None else min(BUFSIZE, limit-fp.tell())
+            data = fp.read(n)
+            if not data: break
+            chan.sendall(data)
+            while chan.recv_ready():
+                out += chan.recv(65536)
+    if limit is None:
+        chan.shutdown_write()
+        status = chan.recv_exit_status()
+    else:
+        # Collect the chunks reported so far, then cut the connection
+        # without sending EOF or CLOSE.
+        time.sleep(0.5)
+        while chan.recv_ready():
+            out += chan.recv(65536)
+        client.get_transport().sock.close()
+        client.close()
+        return (None, parse_reports(out.decode('utf-8')), '')
+    while chan.recv_ready():
+        out += chan.recv(65536)
+    err = b''
+    while chan.recv_stderr_ready():
+        err += chan.recv_stderr(65536)
+    client.close()
+    return (status, parse_reports(out.decode('utf-8')), err.decode('utf-8'))
+
+def get(connect, remote, fp, offset=0):
+    client = connect()
+    chan = client.get_transport().open_session()
+    chan.exec_command(f'@get -o {offset} {remote}')
+    chan.shutdown_write()
+    err = b''
+    while 1:
+        data = chan.recv(BUFSIZE)
+        if not data: break
+        fp.write(data)
+        while chan.recv_stderr_ready():
+            err += chan.recv_stderr(65536)
+    status = chan.recv_exit_status()
+    while chan.recv_stderr_ready():
+        err += chan.recv_stderr(65536)
+    client.close()
+    return (status, parse_reports(err.decode('utf-8')))
+
+def sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while 1:
+            data = fp.read(BUFSIZE)
+            if not data: break
+            h.update(data)
+    return h.hexdigest()
+
+def main(argv):
+    import getopt
+    def usage():
+        print(f'usage: {argv[0]} [-p port] [-u username] [-i keyfile]'
+              ' [-n mbytes] [-r remotepath] host')
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'p:u:i:n:r:')
+    except getopt.GetoptError:
+        return usage()
+    port = 2200
+    username = None
+    keyfile = None
+    mbytes = 256
+    remote = 'pyrexecd_bench.bin'
+    for (k, v) in opts:
+        if k == '-p': port = int(v)
+        elif k == '-u': username = v
+        elif k == '-i': keyfile = v
+        elif k == '-n': mbytes = int(v)
+        elif k == '-r': remote = v
+    if not args: return usage()
+    host = args[0]
+    size = mbytes*1024*1024
+    def reconnect():
+        return connect(host, port, username, keyfile)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = os.path.join(tmpdir, 'src.bin')
+        with open(src, 'wb') as fp:
+            for _ in range(mbytes):
+                fp.write(os.urandom(1024*1024))
+        digest = (size, sha256(src))
+
+        t0 = time.perf_counter()
+        (status, (_, filehash), err) = put(reconnect, src, remote, digest)
+        t = time.perf_counter() - t0
+        print(f'put: {mbytes/t:8.2f} MB/s, status={status}, ok={filehash == digest}')
+        if err: print(err, end='')
+
+        dst = os.path.join(tmpdir, 'dst.bin')
+        t0 = time.perf_counter()
+        with open(dst, 'wb') as fp:
+            (status, (_, filehash)) = get(reconnect, remote, fp)
+        t = time.perf_counter() - t0
+        ok = (filehash == digest and sha256(dst) == digest[1])
+        print(f'get: {mbytes/t:8.2f} MB/s, status={status}, ok={ok}')
+
+        # Drop the connection in the middle of a @put
+        # and resume it from the last reported chunk.
+        (_, (committed, _), _) = put(reconnect, src, remote, digest,
+                                     limit=size//2)
+        # Give the server a moment to notice the dropped connection.
+        time.sleep(1)
+        t0 = time.perf_counter()
+        (status, (_, filehash), err) = put(reconnect, src, remote, digest,
+                                           offset=committed)
+        t = time.perf_counter() - t0
+        mb = (size-committed)/(1024*1024)
+        print(f'put resumed at {committed}: {mb/t:8.2f} MB/s,'
+              f' status={status}, ok={filehash == digest}')
+        if err: print(err, end='')
+
+        # Resume a @get from the middle.
+        with open(dst, 'r+b') as fp:
+            fp.truncate(size//2)
+            fp.seek(size//2)
+            t0 = time.perf_counter()
+            (status, (_, filehash)) = get(reconnect, remote, fp, offset=size//2)
+            t = time.perf_counter() - t0
+        ok = (filehash == digest and sha256(dst) == digest[1])
+        print(f'get resumed at {size//2}: {mbytes/2/t:8.2f} MB/s,'
+              f' status={status}, ok={ok}')
+    return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))